@@ -1,10 +1,10 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Query
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 import os
+import threading
 from dotenv import load_dotenv
-from whoosh import index
-from search import create_schema, index_documents, search_documents, get_all_documents, get_indexed_terms, get_document_terms
+from search import PASSAGE_THRESHOLD, PASSAGE_SIZE, REBUILD_LIMITMB, REBUILD_PROCS, validate_passage_limits, create_schema, open_index, rebuild_index, collect_generations, index_documents, search_documents, get_all_documents, get_indexed_terms, get_document_terms, get_document_top_terms
 from logging_setup import logger
 
 # Load environment variables
@@ -15,16 +15,30 @@ app = FastAPI(title="Document Searcher API")
 # Get environment variables
 doc_dir = os.getenv('DOC_DIR')
 index_dir = os.getenv('INDEX_DIR')
+store_term_vectors = os.getenv('STORE_TERM_VECTORS', 'false').lower() in ('1', 'true', 'yes')
+passage_threshold = int(os.getenv('PASSAGE_THRESHOLD', PASSAGE_THRESHOLD))
+passage_size = int(os.getenv('PASSAGE_SIZE', PASSAGE_SIZE))
+validate_passage_limits(passage_threshold, passage_size)
+rebuild_limitmb = int(os.getenv('REBUILD_LIMITMB', REBUILD_LIMITMB))
+rebuild_procs = int(os.getenv('REBUILD_PROCS', REBUILD_PROCS))
+keep_generations = int(os.getenv('KEEP_GENERATIONS', 1))
+
+schema = create_schema(term_vectors=store_term_vectors)
+
+# Only one rebuild or reindex may write at a time
+index_lock = threading.Lock()
+
+def rebuild():
+    return rebuild_index(index_dir, doc_dir, schema, limitmb=rebuild_limitmb, procs=rebuild_procs,
+                         passage_threshold=passage_threshold, passage_size=passage_size)
 
 # Create or open the index
-schema = create_schema()
-if not os.path.exists(index_dir):
-    os.mkdir(index_dir)
-    index_obj = index.create_in(index_dir, schema)
+index_obj = open_index(index_dir) if os.path.exists(index_dir) else None
+if index_obj is None:
     logger.info("Indexing documents...")
-    index_documents(index_obj, doc_dir, delete=True)
+    index_obj = rebuild()
+    collect_generations(index_dir, keep=keep_generations)
 else:
-    index_obj = index.open_dir(index_dir)
     logger.info("Opening existing index...")
 
 class SearchQuery(BaseModel):
@@ -37,6 +51,10 @@ class SearchResult(BaseModel):
     score: float
     language: str
 
+class TermFrequency(BaseModel):
+    term: str
+    frequency: int
+
 @app.post("/search", response_model=List[SearchResult])
 async def search(query: SearchQuery):
     results = search_documents(index_obj, query.query)
@@ -44,7 +62,8 @@ async def search(query: SearchQuery):
         raise HTTPException(status_code=404, detail="No results found")
     return results
 
-@app.get("/documents", response_model=List[dict])
+@app.get("/documents", response_model=List[dict],
+         description="Stored fields of every indexed file. Files split into passages are listed once, without their content.")
 async def get_documents():
     return get_all_documents(index_obj)
 
@@ -55,19 +74,52 @@ async def get_terms(field_name: str):
         raise HTTPException(status_code=404, detail=f"No terms found for field: {field_name}")
     return terms
 
-@app.get("/document_terms")
-async def get_doc_terms(doc_path: str, field_name: str):
-    terms = get_document_terms(index_obj, doc_path, field_name)
-    if not terms:
+@app.get("/document_terms", description="Distinct indexed terms of a document in sorted order, paginated with offset/limit. "
+                                         "Earlier versions returned the full token stream in document order, with repeats.")
+async def get_doc_terms(doc_path: str, field_name: str, offset: int = Query(0, ge=0), limit: Optional[int] = Query(None, ge=1)):
+    terms = get_document_terms(index_obj, doc_path, field_name, offset=offset, limit=limit)
+    # A page past the last term is empty, only 404 when the document has no terms at all
+    if not terms and (offset == 0 or not get_document_terms(index_obj, doc_path, field_name, limit=1)):
+        raise HTTPException(status_code=404, detail="No terms found for the specified document and field")
+    return terms
+
+@app.get("/document_top_terms", response_model=List[TermFrequency])
+async def get_doc_top_terms(doc_path: str, field_name: str, limit: int = Query(10, ge=1), offset: int = Query(0, ge=0)):
+    terms = get_document_top_terms(index_obj, doc_path, field_name, limit=limit, offset=offset)
+    if not terms and (offset == 0 or not get_document_top_terms(index_obj, doc_path, field_name, limit=1)):
         raise HTTPException(status_code=404, detail="No terms found for the specified document and field")
     return terms
 
 @app.post("/reindex")
 async def reindex():
     global index_obj
-    index_documents(index_obj, doc_dir)
+    if not index_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Indexing already in progress")
+    try:
+        index_documents(index_obj, doc_dir, passage_threshold=passage_threshold, passage_size=passage_size)
+    finally:
+        index_lock.release()
     return {"message": "Reindexing complete"}
 
+def run_rebuild():
+    global index_obj
+    try:
+        # Searches keep using the current generation until the new one is swapped in
+        index_obj = rebuild()
+        # New searches use the swapped-in generation; the one it replaced is kept until the next collection
+        collect_generations(index_dir, keep=keep_generations)
+    except Exception as e:
+        logger.error(f"Rebuild failed: {str(e)}")
+    finally:
+        index_lock.release()
+
+@app.post("/rebuild")
+async def rebuild_endpoint(background_tasks: BackgroundTasks):
+    if not index_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Indexing already in progress")
+    background_tasks.add_task(run_rebuild)
+    return {"message": "Rebuild started"}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
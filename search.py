@@ -1,30 +1,119 @@
 import os
+import re
+import shutil
 from whoosh import index, fields, writing
 from whoosh.qparser import MultifieldParser
 from langdetect import detect
 from extractors import extract_text, audio_files_queue, process_audio_queue
 import unicodedata
+from collections import Counter
 from analyzer import MultiLingualAnalyzer
 from logging_setup import logger
 
-def create_schema():
+def create_schema(term_vectors=False):
+    # With term_vectors enabled, every document keeps its own term/frequency
+    # table so per-document term lookups don't have to re-run the analyzer
     my_analyzer = MultiLingualAnalyzer()
 
     return fields.Schema(
         path=fields.ID(stored=True, unique=True, sortable=True),
-        filename=fields.TEXT(stored=True, analyzer=my_analyzer),
+        filename=fields.TEXT(stored=True, analyzer=my_analyzer, vector=term_vectors),
         extension=fields.TEXT(stored=True),
-        content=fields.TEXT(stored=True, analyzer=my_analyzer),
+        content=fields.TEXT(stored=True, analyzer=my_analyzer, vector=term_vectors),
         language=fields.TEXT(stored=True),
         skipped=fields.BOOLEAN(stored=True),
-        time=fields.STORED
+        time=fields.STORED,
+        passage=fields.NUMERIC(stored=True),
+        parent_fields=fields.STORED
     )
 
-def index_documents(index_obj, doc_dir, delete=False):
+# Documents longer than PASSAGE_THRESHOLD characters are indexed as a stream of
+# passages of roughly PASSAGE_SIZE characters that share the parent's path
+PASSAGE_THRESHOLD = 200000
+PASSAGE_SIZE = 20000
+# Language detection only looks at the start of a document
+LANGUAGE_SAMPLE_SIZE = 5000
+
+def validate_passage_limits(passage_threshold, passage_size):
+    if passage_size < 1:
+        raise ValueError(f"PASSAGE_SIZE must be at least 1, got {passage_size}")
+    if passage_threshold < passage_size:
+        raise ValueError(f"PASSAGE_THRESHOLD ({passage_threshold}) must not be smaller than PASSAGE_SIZE ({passage_size})")
+
+def _ensure_passage_fields(index_obj):
+    # Indexes created before passages existed don't have the fields yet
+    missing = [name for name in ('passage', 'parent_fields') if name not in index_obj.schema]
+    if missing:
+        with index_obj.writer() as writer:
+            if 'passage' in missing:
+                writer.add_field('passage', fields.NUMERIC(stored=True))
+            if 'parent_fields' in missing:
+                writer.add_field('parent_fields', fields.STORED)
+
+def _iter_passages(content, passage_size):
+    start = 0
+    length = len(content)
+    while start < length:
+        end = min(start + passage_size, length)
+        if end < length:
+            # Don't cut words in half, break after the last whitespace in the window
+            split = max(content.rfind(' ', start, end), content.rfind('\n', start, end))
+            if split > start:
+                end = split + 1
+        yield content[start:end]
+        start = end
+
+def _add_document(writer, file_path, content, skipped, passage_threshold, passage_size):
+    filename, extension = os.path.splitext(os.path.basename(file_path))
+    normalized_filename = unicodedata.normalize('NFC', filename)
+
+    try:
+        lang = detect(content[:LANGUAGE_SAMPLE_SIZE])
+    except:
+        try:
+            lang = detect(filename)
+        except:
+            lang = 'unknown'
+
+    logger.debug(f"Adding document: {normalized_filename}{extension}")
+    logger.debug(f"Language: {lang}")
+    logger.debug(f"Content: {content[:100]}...")
+
+    document = dict(
+        path=file_path,
+        filename=normalized_filename,
+        extension=extension,
+        language=lang,
+        skipped=skipped,
+        time=os.path.getmtime(file_path)
+    )
+
+    if len(content) <= passage_threshold:
+        writer.add_document(content=content, **document)
+        return
+
+    # Only the first passage indexes the filename, extension and language, so a split
+    # document still counts once for those terms; the rest keep them for display
+    metadata = {name: document.pop(name) for name in ('filename', 'extension', 'language')}
+    passages = 0
+    for passage, text in enumerate(_iter_passages(content, passage_size)):
+        if passage == 0:
+            writer.add_document(content=text, passage=passage, **metadata, **document)
+        else:
+            writer.add_document(content=text, passage=passage, parent_fields=metadata, **document)
+        passages += 1
+    logger.info(f"Indexed {normalized_filename}{extension} as {passages} passages")
+
+def index_documents(index_obj, doc_dir, delete=False, passage_threshold=PASSAGE_THRESHOLD, passage_size=PASSAGE_SIZE, writer_options=None):
+    writer_options = writer_options or {}
+    validate_passage_limits(passage_threshold, passage_size)
+
     if delete:
         writer = index_obj.writer()
         writer.commit(mergetype=writing.CLEAR)
 
+    _ensure_passage_fields(index_obj)
+
     indexed_paths = set()
     to_index = set()
 
@@ -32,6 +121,9 @@ def index_documents(index_obj, doc_dir, delete=False):
     with index_obj.searcher() as searcher:
         for fields in searcher.all_stored_fields():
             indexed_path = fields['path']
+            if indexed_path in indexed_paths:
+                # Remaining passages of a document that was already checked
+                continue
             indexed_paths.add(indexed_path)
 
             if not os.path.exists(indexed_path):
@@ -47,108 +139,225 @@ def index_documents(index_obj, doc_dir, delete=False):
                         to_index.add(indexed_path)
 
     # Index new or updated documents
-    with index_obj.writer() as writer:
+    with index_obj.writer(**writer_options) as writer:
         for root, _, files in os.walk(doc_dir):
             for file in files:
                 file_path = os.path.join(root, file)
                 if file_path in to_index or file_path not in indexed_paths:
-                    filename, extension = os.path.splitext(file)
+                    # extract_text already returns NFC-normalized text
                     content = extract_text(file_path)
                     skipped = False
                     if not content:
                         skipped = True
                         
                     logger.info(f"Indexing: {file}")
-                    
-                    try:
-                        lang = detect(content)
-                    except:
-                        try:
-                            lang = detect(filename)
-                        except:
-                            lang = 'unknown'
-                    
-                    normalized_content = unicodedata.normalize('NFC', content)
-                    normalized_filename = unicodedata.normalize('NFC', filename)
-                    
-                    logger.debug(f"Adding document: {normalized_filename}{extension}")
-                    logger.debug(f"Language: {lang}")
-                    logger.debug(f"Content: {normalized_content[:100]}...")
-                    
-                    writer.add_document(
-                        path=file_path,
-                        filename=normalized_filename,
-                        extension=extension,
-                        content=normalized_content,
-                        language=lang,
-                        skipped=skipped,
-                        time=os.path.getmtime(file_path)
-                    )
+                    _add_document(writer, file_path, content, skipped, passage_threshold, passage_size)
+                    # Release the text before the next extraction instead of after it
+                    del content
 
     logger.info("Audio files queue: {}".format(audio_files_queue))
     
     # Process audio files in the queue
     while audio_files_queue:
         results = process_audio_queue()
-        with index_obj.writer() as writer:
-            for file_path, text in results.items():
+        with index_obj.writer(**writer_options) as writer:
+            for file_path in list(results):
+                text = results.pop(file_path)
                 logger.debug(f"Processed {file_path}: {text[:100]}...")
-                filename, extension = os.path.splitext(os.path.basename(file_path))
                 normalized_content = unicodedata.normalize('NFC', text)
-                normalized_filename = unicodedata.normalize('NFC', filename)
-                try:
-                    lang = detect(text)
-                except:
-                    lang = 'unknown'
-                
-                writer.update_document(
-                    path=file_path,
-                    filename=normalized_filename,
-                    extension=extension,
-                    content=normalized_content,
-                    language=lang,
-                    skipped=False,
-                    time=os.path.getmtime(file_path)
-                )
+                del text
+
+                # Replaces the placeholder document and any passages of an older transcript
+                writer.delete_by_term('path', file_path)
+                _add_document(writer, file_path, normalized_content, False, passage_threshold, passage_size)
             
     logger.info("Indexing complete.")
 
+# A full rebuild goes into a new generation directory under INDEX_DIR while the
+# current one keeps serving; CURRENT_FILE names the generation that is live
+CURRENT_FILE = "CURRENT"
+GENERATION_PREFIX = "gen-"
+REBUILD_LIMITMB = 512
+REBUILD_PROCS = 1
+# Files of an index written directly into INDEX_DIR before generations existed
+LEGACY_INDEX_FILE = re.compile(r'^(_MAIN_\d+\.toc|MAIN_\w+\.\w+|MAIN_WRITELOCK)$')
+
+def _current_generation(index_dir):
+    try:
+        with open(os.path.join(index_dir, CURRENT_FILE), encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def _generations(index_dir):
+    generations = [name for name in os.listdir(index_dir)
+                   if name.startswith(GENERATION_PREFIX) and name[len(GENERATION_PREFIX):].isdigit()]
+    return sorted(generations, key=_generation_number)
+
+def _switch_generation(index_dir, generation):
+    # os.replace is atomic, readers see either the old or the new generation
+    tmp_path = os.path.join(index_dir, CURRENT_FILE + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(generation)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(index_dir, CURRENT_FILE))
+
+def _generation_number(name):
+    return int(name[len(GENERATION_PREFIX):])
+
+def _remove_generation(index_dir, name):
+    try:
+        shutil.rmtree(os.path.join(index_dir, name))
+    except OSError as e:
+        # Files may still be held by an in-flight searcher, retried on the next collection
+        logger.warning(f"Could not remove index generation {name}: {str(e)}")
+
+def _remove_legacy_index(index_dir):
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        if os.path.isfile(path) and LEGACY_INDEX_FILE.match(name):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Could not remove legacy index file {name}: {str(e)}")
+
+def collect_generations(index_dir, keep=1):
+    current = _current_generation(index_dir)
+    if current is None:
+        return
+
+    # Generations newer than the current one are builds that never got switched to
+    old = []
+    for name in _generations(index_dir):
+        if _generation_number(name) > _generation_number(current):
+            logger.info(f"Removing incomplete index generation: {name}")
+            _remove_generation(index_dir, name)
+        elif name != current:
+            old.append(name)
+
+    # The index that served before the last swap may still have searches running on it,
+    # so the most recent old generation is always kept until the next collection
+    keep = max(keep, 1)
+    legacy = any(LEGACY_INDEX_FILE.match(name) for name in os.listdir(index_dir))
+    if legacy:
+        # A legacy index in INDEX_DIR predates every generation
+        old.insert(0, None)
+    for name in old[:max(len(old) - keep, 0)]:
+        if name is None:
+            logger.info("Removing legacy index")
+            _remove_legacy_index(index_dir)
+        else:
+            logger.info(f"Removing old index generation: {name}")
+            _remove_generation(index_dir, name)
+
+def open_index(index_dir):
+    generation = _current_generation(index_dir)
+    if generation and index.exists_in(os.path.join(index_dir, generation)):
+        return index.open_dir(os.path.join(index_dir, generation))
+    if index.exists_in(index_dir):
+        return index.open_dir(index_dir)
+    return None
+
+def rebuild_index(index_dir, doc_dir, schema, limitmb=REBUILD_LIMITMB, procs=REBUILD_PROCS,
+                  passage_threshold=PASSAGE_THRESHOLD, passage_size=PASSAGE_SIZE):
+    os.makedirs(index_dir, exist_ok=True)
+    generations = _generations(index_dir)
+    number = _generation_number(generations[-1]) + 1 if generations else 1
+    generation = f"{GENERATION_PREFIX}{number}"
+    staging_dir = os.path.join(index_dir, generation)
+    os.mkdir(staging_dir)
+
+    logger.info(f"Building index generation {generation}...")
+    try:
+        new_index = index.create_in(staging_dir, schema)
+        # Bulk build: big buffer, one segment per process, merged once at the end
+        writer_options = dict(limitmb=limitmb, procs=procs, multisegment=procs > 1)
+        index_documents(new_index, doc_dir, passage_threshold=passage_threshold, passage_size=passage_size,
+                        writer_options=writer_options)
+        new_index.optimize()
+    except BaseException:
+        # Don't leave a half-written generation behind for collect_generations to keep
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    _switch_generation(index_dir, generation)
+    logger.info(f"Switched to index generation {generation}")
+    return new_index
+
 def search_documents(index_obj, query_string):
     with index_obj.searcher() as searcher:
         fields = ["content", "filename"]
         query_parser = MultifieldParser(fields, schema=index_obj.schema)
         query = query_parser.parse(query_string)
                 
-        results = searcher.search(query, limit=None)
+        # Passages of a large document share its path, keep only the best hit per document
+        results = searcher.search(query, limit=None, collapse="path")
         
         logger.info(f"Number of results: {len(results)}")
         
         search_results = []
         for result in results:
-            highlights = result.highlights("content") or result.highlights("filename") or "No highlights available"
+            stored = result.fields()
+            # Later passages carry the parent's metadata in a stored-only field
+            metadata = stored.get("parent_fields", stored)
+            highlights = result.highlights("content") or ("filename" in stored and result.highlights("filename")) or "No highlights available"
             search_results.append({
                 "path": result["path"],
-                "filename": result["filename"] + result["extension"],
+                "filename": metadata["filename"] + metadata["extension"],
                 "highlights": highlights,
                 "score": result.score,
-                "language": result["language"]
+                "language": metadata["language"]
             })
         
         return search_results
     
 def get_all_documents(index_obj):
     with index_obj.searcher() as searcher:
-        return [dict(doc) for doc in searcher.all_stored_fields()]
+        documents = {}
+        for doc in searcher.all_stored_fields():
+            if 'passage' in doc:
+                # Large documents are listed once, without content since each passage only holds part of it
+                doc = {key: value for key, value in doc.items() if key not in ('content', 'passage')}
+            documents.setdefault(doc['path'], dict(doc))
+        return list(documents.values())
 
 def get_indexed_terms(index_obj, field_name):
     with index_obj.searcher() as searcher:
         return list(searcher.lexicon(field_name))
 
-def get_document_terms(index_obj, doc_path, field_name):
+def _document_term_frequencies(searcher, doc_path, field_name):
+    field = searcher.schema[field_name] if field_name in searcher.schema else None
+    # Only analyzed text fields have per-document terms, not STORED, BOOLEAN, NUMERIC or ID fields
+    if field is None or not field.scorable or getattr(field, 'analyzer', None) is None:
+        return []
+    docnums = list(searcher.document_numbers(path=doc_path))
+    if field_name != 'content':
+        # Passages repeat the parent's other fields, only content is split
+        docnums = docnums[:1]
+
+    counts = Counter()
+    analyzer = searcher.schema[field_name].analyzer
+    for docnum in docnums:
+        if searcher.has_vector(docnum, field_name):
+            for term, freq in searcher.vector_as("frequency", docnum, field_name):
+                counts[term.decode('utf-8') if isinstance(term, bytes) else term] += freq
+        else:
+            # Index was built without term vectors, fall back to re-analyzing the stored field
+            doc = searcher.stored_fields(docnum)
+            if field_name in doc:
+                counts.update(token.text for token in analyzer(doc[field_name]))
+    return sorted(counts.items())
+
+def get_document_terms(index_obj, doc_path, field_name, offset=0, limit=None):
+    # Distinct terms in sorted order, the same with or without term vectors
+    with index_obj.searcher() as searcher:
+        terms = [term for term, _ in _document_term_frequencies(searcher, doc_path, field_name)]
+    end = offset + limit if limit is not None else None
+    return terms[offset:end]
+
+def get_document_top_terms(index_obj, doc_path, field_name, limit=10, offset=0):
     with index_obj.searcher() as searcher:
-        doc = searcher.document(path=doc_path)
-        if doc and field_name in doc:
-            content = doc[field_name]
-            analyzer = index_obj.schema[field_name].analyzer
-            return [token.text for token in analyzer(content)]
-    return []
\ No newline at end of file
+        frequencies = _document_term_frequencies(searcher, doc_path, field_name)
+    frequencies.sort(key=lambda item: (-item[1], item[0]))
+    return [{"term": term, "frequency": freq} for term, freq in frequencies[offset:offset + limit]]